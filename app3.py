@@ -1,10 +1,24 @@
 import streamlit as st
 import os
+import json
+import random
+import shutil
+import re
+import hashlib
+import math
+import string
 import tempfile
 import subprocess
-from pydub import AudioSegment
+import time
+import threading
+import uuid
+import numpy as np
+import openai
 from openai import OpenAI
-from datetime import datetime
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 # ----------------------- Настройка страницы и CSS -----------------------
 st.set_page_config(
@@ -89,67 +103,1384 @@ def load_css():
         </style>
     """, unsafe_allow_html=True)
 
+# ----------------------- Настройки -----------------------
+def get_setting(name, default):
+    # Значение берётся из переменной окружения (имя в верхнем регистре), затем из st.secrets
+    value = os.environ.get(name.upper())
+    if value is None:
+        try:
+            value = st.secrets.get(name, default)
+        except Exception:
+            value = default
+    if isinstance(default, bool) and isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    if default is not None and not isinstance(value, type(default)):
+        return type(default)(value)
+    return value
+
+# Размер блока при потоковом копировании загруженного файла на диск (байт)
+UPLOAD_CHUNK_SIZE = get_setting("upload_chunk_size", 8 * 1024 * 1024)
+
+def with_script_run_ctx(function):
+    # Вызовы st.* из рабочих потоков выводятся на страницу, только если поток
+    # привязан к контексту текущего запуска скрипта
+    ctx = get_script_run_ctx()
+
+    def run(*args, **kwargs):
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return function(*args, **kwargs)
+    return run
+
 # ----------------------- Инициализация OpenAI -----------------------
 def init_openai():
     try:
         # Инициализация клиента OpenAI. API-ключ должен быть указан в st.secrets.
-        return OpenAI(api_key=st.secrets["openai_api_key"])
+        # Встроенные повторы клиента отключены: их выполняет call_with_retry
+        return OpenAI(api_key=st.secrets["openai_api_key"], max_retries=0)
     except Exception as e:
         st.error("Ошибка инициализации OpenAI API: " + str(e))
         return None
 
+# ----------------------- Повторные попытки запросов к OpenAI -----------------------
+# Число попыток и границы экспоненциальной задержки (сек)
+RETRY_MAX_ATTEMPTS = get_setting("retry_max_attempts", 6)
+RETRY_BASE_DELAY = get_setting("retry_base_delay", 1.0)
+RETRY_MAX_DELAY = get_setting("retry_max_delay", 60.0)
+
+# Общая для всех сессий и потоков процесса пауза после ответа 429: пока она не истекла,
+# новые запросы не отправляются, чтобы не усугублять превышение лимита.
+# Streamlit выполняет скрипт заново при каждом запуске, поэтому состояние хранится в cache_resource,
+# а не в глобальных переменных модуля
+@st.cache_resource(show_spinner=False)
+def get_rate_limit_state():
+    return {"lock": threading.Lock(), "resume_at": 0.0}
+
+def parse_reset_duration(value):
+    # Формат заголовков x-ratelimit-reset-*: "1s", "6m0s", "250ms"
+    total = 0.0
+    for amount, unit in re.findall(r"([\d.]+)(ms|h|m|s)", value or ""):
+        total += float(amount) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+    return total or None
+
+def get_retry_after(error):
+    # Задержка, которую просит сервер: retry-after-ms, retry-after (секунды или дата), x-ratelimit-reset-*
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            value = headers["retry-after"]
+            try:
+                return float(value)
+            except ValueError:
+                return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        pass
+    delays = [
+        parse_reset_duration(headers.get(name))
+        for name in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens")
+    ]
+    delays = [delay for delay in delays if delay]
+    return max(delays) if delays else None
+
+def is_retryable(error):
+    # Повторяем сетевые сбои, таймауты, 408/409/429 и ошибки сервера;
+    # исчерпанная квота, ошибки авторизации и запроса — окончательные
+    if isinstance(error, openai.APIConnectionError):
+        return True
+    if isinstance(error, openai.RateLimitError):
+        return getattr(error, "code", None) != "insufficient_quota"
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in (408, 409, 429) or error.status_code >= 500
+    return False
+
+def wait_for_rate_limit():
+    state = get_rate_limit_state()
+    with state["lock"]:
+        delay = state["resume_at"] - time.monotonic()
+    if delay > 0:
+        time.sleep(delay)
+
+def pause_requests(delay):
+    state = get_rate_limit_state()
+    with state["lock"]:
+        state["resume_at"] = max(state["resume_at"], time.monotonic() + delay)
+
+def call_with_retry(function, *args, **kwargs):
+    for attempt in range(1, RETRY_MAX_ATTEMPTS + 1):
+        wait_for_rate_limit()
+        try:
+            return function(*args, **kwargs)
+        except Exception as error:
+            if attempt == RETRY_MAX_ATTEMPTS or not is_retryable(error):
+                raise
+            delay = get_retry_after(error)
+            if delay is None:
+                # Экспоненциальная задержка с полным джиттером, чтобы параллельные запросы не совпадали
+                delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+            delay = min(delay, RETRY_MAX_DELAY)
+            if isinstance(error, openai.RateLimitError):
+                pause_requests(delay)
+            else:
+                time.sleep(delay)
+
 # ----------------------- Генерация номера материала -----------------------
 def generate_case_number():
     now = datetime.now()
     return f"М-{now.strftime('%Y%m%d')}-{now.strftime('%H%M%S')}"
 
-# ----------------------- Проверка наличия FFmpeg -----------------------
-def check_ffmpeg():
+# ----------------------- Возможности FFmpeg -----------------------
+def run_tool(command):
     try:
-        subprocess.run(["ffmpeg", "-version"], check=True, capture_output=True)
-        return True
+        return subprocess.run(command, check=True, capture_output=True).stdout.decode(errors="replace")
     except (subprocess.CalledProcessError, FileNotFoundError):
+        return None
+
+def parse_codec_list(output):
+    # Строки вида " A....D libopus   libopus Opus" после разделителя " ------": имя -> флаги
+    names = {}
+    started = False
+    for line in (output or "").splitlines():
+        if line.strip().startswith("------"):
+            started = True
+            continue
+        parts = line.split()
+        if started and len(parts) >= 2:
+            names[parts[1]] = parts[0]
+    return names
+
+@st.cache_resource(show_spinner=False)
+def get_ffmpeg_capabilities():
+    # Проверяется один раз на процесс, а не при каждом перезапуске сценария Streamlit
+    version = run_tool(["ffmpeg", "-version"])
+    return {
+        "ffmpeg": version is not None,
+        "ffprobe": run_tool(["ffprobe", "-version"]) is not None,
+        "version": version.splitlines()[0] if version else None,
+        "encoders": set(parse_codec_list(run_tool(["ffmpeg", "-hide_banner", "-encoders"]))),
+        "decoders": set(parse_codec_list(run_tool(["ffmpeg", "-hide_banner", "-decoders"]))),
+        # Имена кодеков (как их сообщает ffprobe), которые эта сборка умеет декодировать
+        "decodable_codecs": {
+            name for name, flags in parse_codec_list(run_tool(["ffmpeg", "-hide_banner", "-codecs"])).items()
+            if flags.startswith("D")
+        },
+    }
+
+# ----------------------- Потоковое сохранение загрузки -----------------------
+def copy_upload(uploaded_file, output, chunk_size=None):
+    # Копируем загрузку блоками фиксированного размера через один переиспользуемый буфер,
+    # чтобы пиковое потребление памяти не зависело от размера файла.
+    # Попутно считается SHA-256 загрузки (ключ кэша транскрипций); output=None — только хэш
+    chunk_size = chunk_size or UPLOAD_CHUNK_SIZE
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    digest = hashlib.sha256()
+    copied = 0
+    uploaded_file.seek(0)
+    started = time.perf_counter()
+    while True:
+        read = uploaded_file.readinto(buffer)
+        if not read:
+            break
+        digest.update(view[:read])
+        if output is not None:
+            output.write(view[:read])
+        copied += read
+    elapsed = time.perf_counter() - started
+    return {
+        "bytes": copied,
+        "seconds": elapsed,
+        "rate": copied / elapsed if elapsed > 0 else 0.0,  # байт/сек
+        "sha256": digest.hexdigest(),
+    }
+
+def save_upload(uploaded_file, suffix, chunk_size=None):
+    tmpfile = tempfile.NamedTemporaryFile(delete=False, suffix=suffix)
+    try:
+        with tmpfile:
+            stats = copy_upload(uploaded_file, tmpfile, chunk_size)
+    except Exception:
+        os.remove(tmpfile.name)
+        raise
+    return tmpfile.name, stats
+
+def format_ingest_stats(stats):
+    megabytes = stats["bytes"] / (1024 * 1024)
+    rate = stats["rate"] / (1024 * 1024)
+    return f"Входной файл: {megabytes:.1f} МБ за {stats['seconds']:.1f} сек. ({rate:.1f} МБ/с)"
+
+# ----------------------- Сведения о медиафайле -----------------------
+# Аудиоформаты, которые API транскрибации принимает напрямую, без перекодирования
+API_AUDIO_FORMATS = (".flac", ".m4a", ".mp3", ".mpga", ".oga", ".ogg", ".wav")
+
+# Кодеки, дорожку которых можно скопировать без перекодирования, и контейнер для результата
+COPYABLE_AUDIO_CODECS = {
+    "aac": ".m4a",
+    "mp3": ".mp3",
+    "flac": ".flac",
+    "vorbis": ".ogg",
+    "opus": ".ogg",
+}
+
+# Режим извлечения: "pipe" — видео подаётся ffmpeg через stdin без записи на диск,
+# "file" — видео сначала сохраняется во временный файл, "auto" — pipe, если контейнер это допускает
+EXTRACTION_MODE = get_setting("extraction_mode", "auto")
+# Сколько байт с начала загрузки передаётся ffprobe в режиме pipe
+PROBE_HEAD_SIZE = get_setting("probe_head_size", 16 * 1024 * 1024)
+
+# Ограничение API транскрибации на размер одного файла
+API_MAX_FILE_SIZE = 25 * 1024 * 1024
+
+# Профили кодирования аудио. Для распознавания речи достаточно 16 кГц моно с низким битрейтом:
+# файл получается в разы меньше, быстрее загружается и реже превышает лимит API.
+# copy — когда подходящая дорожка (например, AAC из MP4/MOV) копируется без перекодирования:
+# "always" — всегда; "api_limit" — если часть стандартной длины (TRANSCRIBE_CHUNK_SECONDS) укладывается
+# в лимит API. Так типичная дорожка 96–128 кбит/с копируется и в речевых профилях: транскрибация
+# разбивает её на части, а время перекодирования экономится
+ENCODING_PROFILES = {
+    "speech_opus": {
+        "ext": ".ogg",
+        "args": ["-ac", "1", "-ar", "16000", "-c:a", "libopus", "-b:a", "24k", "-application", "voip"],
+        "encoder": "libopus",
+        "fallback": "speech_mp3",
+        "copy": "api_limit",
+    },
+    "speech_mp3": {
+        "ext": ".mp3",
+        "args": ["-ac", "1", "-ar", "16000", "-c:a", "libmp3lame", "-b:a", "32k"],
+        "encoder": "libmp3lame",
+        "fallback": None,
+        "copy": "api_limit",
+    },
+    # Исходное качество: MP3 VBR с наивысшим качеством, подходящие дорожки копируются всегда
+    "source": {
+        "ext": ".mp3",
+        "args": ["-c:a", "libmp3lame", "-q:a", "0"],
+        "encoder": "libmp3lame",
+        "fallback": None,
+        "copy": "always",
+    },
+}
+ENCODING_PROFILE = get_setting("encoding_profile", "speech_opus")
+# Без случайных серийных номеров потоков и меток времени одинаковый вход даёт побайтно одинаковое аудио,
+# что нужно для кэша транскрипций по содержимому
+BITEXACT_ARGS = ["-map_metadata", "-1", "-fflags", "+bitexact", "-flags:a", "+bitexact"]
+
+def resolve_encoding_profile(name):
+    # Если в сборке FFmpeg нет нужного кодировщика, переходим на запасной профиль
+    encoders = get_ffmpeg_capabilities()["encoders"]
+    while ENCODING_PROFILES[name]["encoder"] not in encoders and ENCODING_PROFILES[name]["fallback"]:
+        name = ENCODING_PROFILES[name]["fallback"]
+    return name
+
+# Параллельное извлечение: число одновременных процессов ffmpeg, минимальная длительность записи
+# и минимальная длина одного отрезка (сек)
+PARALLEL_EXTRACTION_SLICES = get_setting("parallel_extraction_slices", os.cpu_count() or 1)
+PARALLEL_EXTRACTION_MIN_DURATION = get_setting("parallel_extraction_min_duration", 1800.0)
+PARALLEL_EXTRACTION_MIN_SLICE = get_setting("parallel_extraction_min_slice", 300.0)
+
+# Контейнеры, распознаваемые по сигнатуре: расширение временного файла, демультиплексор ffmpeg
+# и принимает ли API транскрибации такой файл без извлечения дорожки
+CONTAINERS = {
+    "mp4": {"suffix": ".mp4", "demuxer": "mov", "api": True},
+    "m4a": {"suffix": ".m4a", "demuxer": "mov", "api": True},
+    "mov": {"suffix": ".mov", "demuxer": "mov", "api": False},
+    "3gp": {"suffix": ".3gp", "demuxer": "mov", "api": False},
+    "avi": {"suffix": ".avi", "demuxer": "avi", "api": False},
+    "matroska": {"suffix": ".mkv", "demuxer": "matroska", "api": False},
+    "webm": {"suffix": ".webm", "demuxer": "matroska", "api": True},
+    "mpegts": {"suffix": ".ts", "demuxer": "mpegts", "api": False},
+    "wav": {"suffix": ".wav", "demuxer": "wav", "api": True},
+    "mp3": {"suffix": ".mp3", "demuxer": "mp3", "api": True},
+    "aac": {"suffix": ".aac", "demuxer": "aac", "api": False},
+    "flac": {"suffix": ".flac", "demuxer": "flac", "api": True},
+    "ogg": {"suffix": ".ogg", "demuxer": "ogg", "api": True},
+}
+# Сколько байт с начала файла нужно для распознавания контейнера
+SNIFF_SIZE = 512
+
+def get_upload_suffix(uploaded_file):
+    return os.path.splitext(uploaded_file.name or "")[1].lower()
+
+def get_upload_size(uploaded_file):
+    uploaded_file.seek(0, os.SEEK_END)
+    return uploaded_file.tell()
+
+def sniff_container(head):
+    # Определяем контейнер по сигнатуре в первых байтах, а не по имени файла
+    if head[4:8] == b"ftyp":
+        brand = head[8:12]
+        if brand == b"qt  ":
+            return "mov"
+        if brand in (b"M4A ", b"M4B "):
+            return "m4a"
+        if brand.startswith(b"3g"):
+            return "3gp"
+        return "mp4"
+    if head[4:8] in (b"moov", b"mdat", b"wide", b"free", b"skip"):
+        return "mov"
+    if head[:4] == b"RIFF" and head[8:12] == b"AVI ":
+        return "avi"
+    if head[:4] == b"RIFF" and head[8:12] == b"WAVE":
+        return "wav"
+    if head[:4] == b"\x1a\x45\xdf\xa3":
+        return "webm" if b"webm" in head[:64] else "matroska"
+    if head[:4] == b"OggS":
+        return "ogg"
+    if head[:4] == b"fLaC":
+        return "flac"
+    if head[:3] == b"ID3":
+        return "mp3"
+    if len(head) >= 2 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0:
+        # Синхрослово MPEG-аудио: нулевой слой означает ADTS (AAC), иначе MP3
+        return "aac" if (head[1] >> 1) & 0x03 == 0 else "mp3"
+    if len(head) > 188 and head[0] == 0x47 and head[188] == 0x47:
+        return "mpegts"
+    return None
+
+def has_video_stream(probe):
+    # Обложка альбома в MP3/M4A тоже видеопоток, но с признаком attached_pic
+    return any(
+        stream.get("codec_type") == "video" and not stream.get("disposition", {}).get("attached_pic")
+        for stream in probe.get("streams", [])
+    )
+
+def is_api_ready(media):
+    # Файл без видео в контейнере, который принимает API, отправляется без извлечения дорожки
+    if has_video_stream(media["probe"]):
         return False
+    if media["container"]:
+        return CONTAINERS[media["container"]]["api"]
+    return media["suffix"] in API_AUDIO_FORMATS
+
+def scan_mp4_layout(uploaded_file):
+    # Обходим верхнеуровневые боксы MP4/MOV по заголовкам, не читая данные:
+    # "moov_first" — индекс перед данными, файл можно читать из канала;
+    # "moov_last" — индекс после данных (mdat), ffmpeg нужен переход по файлу;
+    # "truncated" — индекс отсутствует или бокс выходит за конец файла.
+    # Возвращает (раскладка, смещение конца бокса moov или None)
+    total = get_upload_size(uploaded_file)
+    header = bytearray(16)
+    offset = 0
+    layout = None
+    moov_end = None
+    while offset < total:
+        uploaded_file.seek(offset)
+        read = uploaded_file.readinto(header)
+        if read < 8:
+            return "truncated", None
+        size = int.from_bytes(header[:4], "big")
+        box = bytes(header[4:8])
+        if size == 1:
+            if read < 16:
+                return "truncated", None
+            size = int.from_bytes(header[8:16], "big")
+        elif size == 0:
+            size = total - offset  # бокс продолжается до конца файла
+        if size < 8 or offset + size > total:
+            return "truncated", None
+        if box == b"moov" and layout is None:
+            layout = "moov_first"
+            moov_end = offset + size
+        elif box == b"mdat" and layout is None:
+            layout = "moov_last"
+        elif box == b"moov":
+            return layout, offset + size
+        offset += size
+    return ("moov_first", moov_end) if layout == "moov_first" else ("truncated", None)
+
+def probe_media(source, input_format=None):
+    # Сведения о потоках и контейнере через ffprobe, без декодирования.
+    # source — путь к файлу или начало загрузки (bytes), которое подаётся через stdin;
+    # известный заранее демультиплексор избавляет ffprobe от угадывания формата
+    from_pipe = not isinstance(source, str)
+    result = subprocess.run([
+        "ffprobe",
+        "-v", "error",
+        "-show_streams",
+        "-show_format",
+        "-of", "json",
+        *(["-f", input_format] if input_format else []),
+        "pipe:0" if from_pipe else source
+    ], input=source if from_pipe else None, check=True, capture_output=True)
+    return json.loads(result.stdout or b"{}")
+
+def get_audio_stream(probe):
+    for stream in probe.get("streams", []):
+        if stream.get("codec_type") == "audio":
+            return stream
+    return None
+
+def get_audio_info(audio_path, probe=None):
+    # Длительность и параметры дорожки читаются из метаданных контейнера, без декодирования в PCM
+    if probe is None:
+        probe = probe_media(audio_path)
+    stream = get_audio_stream(probe) or {}
+    container = probe.get("format", {})
+    duration = stream.get("duration") or container.get("duration") or 0
+    bit_rate = stream.get("bit_rate") or container.get("bit_rate") or 0
+    return {
+        "duration": float(duration),  # длительность в секундах
+        "sample_rate": int(stream.get("sample_rate") or 0),
+        "channels": int(stream.get("channels") or 0),
+        "bit_rate": int(bit_rate),
+        "codec": stream.get("codec_name"),
+    }
+
+# ----------------------- Предварительная проверка файла -----------------------
+# Предельные размер загрузки (байт) и длительность записи (сек), при превышении файл отклоняется сразу
+MAX_UPLOAD_SIZE = get_setting("max_upload_size", 5 * 1024 * 1024 * 1024)
+MAX_MEDIA_DURATION = get_setting("max_media_duration", 6 * 3600.0)
+
+def discard_media(media):
+    path = media.get("path")
+    if path and os.path.exists(path):
+        os.remove(path)
+    media["path"] = None
+
+def preflight_media(uploaded_file, chunk_size=None):
+    # Быстрая проверка сразу после загрузки: размер, целостность контейнера, потоки и длительность.
+    # Непригодный файл отклоняется до запуска ffmpeg и платной транскрибации, а результат ffprobe
+    # передаётся дальше по конвейеру, чтобы следующие этапы не запускали его повторно
+    size = get_upload_size(uploaded_file)
+    if size == 0:
+        raise ValueError("Файл пуст.")
+    if size > MAX_UPLOAD_SIZE:
+        raise ValueError(
+            f"Файл слишком большой: {size / 1024 ** 3:.1f} ГБ "
+            f"(допустимо не более {MAX_UPLOAD_SIZE / 1024 ** 3:.1f} ГБ)."
+        )
+
+    # Контейнер определяется по сигнатуре: от него зависят расширение, демультиплексор и быстрые пути
+    uploaded_file.seek(0)
+    container = sniff_container(uploaded_file.read(SNIFF_SIZE))
+    suffix = CONTAINERS[container]["suffix"] if container else get_upload_suffix(uploaded_file)
+    demuxer = CONTAINERS[container]["demuxer"] if container else None
+
+    layout, moov_end = scan_mp4_layout(uploaded_file) if demuxer == "mov" else (None, None)
+    if layout == "truncated":
+        raise ValueError("Файл повреждён или загружен не полностью: данные MP4/MOV обрываются.")
+
+    media = {
+        "container": container,
+        "suffix": suffix,
+        "demuxer": demuxer,
+        "size": size,
+        "layout": layout,
+        "path": None,
+        "ingest": None,
+    }
+    try:
+        if layout == "moov_last":
+            # Индекс в конце файла: ffprobe и ffmpeg нужен переход по файлу, поэтому сохраняем его сразу
+            media["path"], media["ingest"] = save_upload(uploaded_file, suffix, chunk_size)
+            probe = probe_media(media["path"], demuxer)
+        else:
+            # ffprobe должен получить индекс целиком: у многочасовой записи бокс moov бывает больше PROBE_HEAD_SIZE
+            uploaded_file.seek(0)
+            probe = probe_media(uploaded_file.read(max(PROBE_HEAD_SIZE, moov_end or 0)), demuxer)
+    except subprocess.CalledProcessError as e:
+        discard_media(media)
+        raise ValueError("Не удалось прочитать файл: " + e.stderr.decode(errors="replace").strip())
+
+    audio_stream = get_audio_stream(probe)
+    info = get_audio_info(None, probe)
+    duration = info["duration"]
+    if not duration and media["path"] is None and not has_video_stream(probe) and info["bit_rate"]:
+        # По началу потока длительность аудиофайла оценивается по битрейту и размеру
+        duration = size * 8 / info["bit_rate"]
+
+    if audio_stream is None:
+        discard_media(media)
+        raise ValueError("В файле нет звуковой дорожки.")
+    codec = audio_stream.get("codec_name")
+    if codec not in COPYABLE_AUDIO_CODECS and codec not in get_ffmpeg_capabilities()["decodable_codecs"]:
+        discard_media(media)
+        raise ValueError(f"Звуковая дорожка в кодеке {codec} не поддерживается установленным FFmpeg.")
+    if not duration and media["path"] is not None:
+        discard_media(media)
+        raise ValueError("Не удалось определить длительность записи: файл повреждён или обрезан.")
+    if duration > MAX_MEDIA_DURATION:
+        discard_media(media)
+        raise ValueError(
+            f"Запись слишком длинная: {duration / 3600:.1f} ч "
+            f"(допустимо не более {MAX_MEDIA_DURATION / 3600:.1f} ч)."
+        )
+
+    # Хэш загрузки нужен до извлечения аудио, чтобы найти готовую транскрипцию в кэше;
+    # если файл уже сохранён на диск, хэш посчитан при копировании
+    if media["ingest"]:
+        sha256 = media["ingest"]["sha256"]
+    else:
+        sha256 = copy_upload(uploaded_file, None, chunk_size)["sha256"]
+
+    media.update(probe=probe, audio_stream=audio_stream, duration=duration or None, sha256=sha256)
+    return media
 
 # ----------------------- Извлечение аудио из видео -----------------------
-def extract_audio(uploaded_file):
-    # Сохраняем временный видеофайл
-    with tempfile.NamedTemporaryFile(delete=False, suffix='.mp4') as tmpfile:
-        tmpfile.write(uploaded_file.read())
-        video_path = tmpfile.name
-
-    audio_path = os.path.splitext(video_path)[0] + '.mp3'
-    
+def run_ffmpeg_audio(video_path, audio_path, codec_args, uploaded_file=None, chunk_size=None, input_format=None):
+    # Если передан uploaded_file, вход подаётся ffmpeg через stdin и видео не записывается на диск;
+    # в этом случае возвращается статистика передачи
+    command = [
+        "ffmpeg",
+        "-y",
+        "-loglevel", "error",
+        *(["-f", input_format] if input_format else []),
+        "-i", "pipe:0" if uploaded_file is not None else video_path,
+        "-map", "0:a:0",
+        "-vn",
+        *codec_args,
+        *BITEXACT_ARGS,
+        audio_path
+    ]
+    if uploaded_file is None:
+        subprocess.run(command, check=True, capture_output=True)
+        return None
+
+    process = subprocess.Popen(
+        command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+    )
+    feed = {}
+
+    def write_input():
+        try:
+            feed["stats"] = copy_upload(uploaded_file, process.stdin, chunk_size)
+        except BrokenPipeError:
+            # ffmpeg завершился, не дочитав вход; результат определяется по коду возврата
+            pass
+        finally:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    writer = threading.Thread(target=write_input, daemon=True)
+    writer.start()
+    stderr = process.stderr.read()
+    process.wait()
+    writer.join()
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command, stderr=stderr)
+    return feed.get("stats")
+
+def new_audio_base():
+    return os.path.join(tempfile.gettempdir(), f"audio_{uuid.uuid4().hex}")
+
+def can_copy_stream(stream, profile):
+    # Копируем дорожку, только если кодек подходит и поток не тяжелее, чем допускает профиль
+    if not stream or stream.get("codec_name") not in COPYABLE_AUDIO_CODECS:
+        return False
+    if profile["copy"] == "always":
+        return True
+    bit_rate = int(stream.get("bit_rate") or 0)
+    return 0 < bit_rate <= API_SAFE_FILE_SIZE * 8 / TRANSCRIBE_CHUNK_SECONDS
+
+def extract_audio_track(video_path, output_base, stream, profile, uploaded_file=None, chunk_size=None,
+                        input_format=None):
+    if can_copy_stream(stream, profile):
+        # Дорожка уже в подходящем кодеке: перепаковываем без декодирования
+        audio_path = output_base + COPYABLE_AUDIO_CODECS[stream["codec_name"]]
+        try:
+            ingest = run_ffmpeg_audio(
+                video_path, audio_path, ["-c:a", "copy"], uploaded_file, chunk_size, input_format
+            )
+            return audio_path, "copy", ingest
+        except subprocess.CalledProcessError:
+            if os.path.exists(audio_path):
+                os.remove(audio_path)
+
+    audio_path = output_base + profile["ext"]
     try:
+        ingest = run_ffmpeg_audio(
+            video_path, audio_path, profile["args"], uploaded_file, chunk_size, input_format
+        )
+    except Exception:
+        if os.path.exists(audio_path):
+            os.remove(audio_path)
+        raise
+    return audio_path, "transcode", ingest
+
+def finish_extraction(audio_path, meta, probe=None):
+    try:
+        info = get_audio_info(audio_path, probe)
+    except Exception:
+        os.remove(audio_path)
+        raise
+    return audio_path, {**info, **meta}
+
+def get_slice_count(duration, stream, profile):
+    # Параллельная нарезка имеет смысл только для длинных записей, которые нужно перекодировать
+    if PARALLEL_EXTRACTION_SLICES < 2 or not duration or duration < PARALLEL_EXTRACTION_MIN_DURATION:
+        return 1
+    if can_copy_stream(stream, profile):
+        return 1
+    return max(1, min(PARALLEL_EXTRACTION_SLICES, int(duration // PARALLEL_EXTRACTION_MIN_SLICE)))
+
+def extract_audio_parallel(video_path, output_base, duration, profile, slices, input_format=None):
+    # Делим шкалу времени на slices отрезков и кодируем их параллельными процессами ffmpeg,
+    # затем склеиваем части без перекодирования
+    bounds = [duration * i / slices for i in range(slices + 1)]
+    slice_paths = [f"{output_base}_part{i:03d}{profile['ext']}" for i in range(slices)]
+    list_path = output_base + "_parts.txt"
+    audio_path = output_base + profile["ext"]
+
+    def encode_slice(index):
+        # -ss перед -i: ffmpeg переходит к нужному месту по индексу контейнера, не декодируя начало
+        limit = [] if index == slices - 1 else ["-t", f"{bounds[index + 1] - bounds[index]:.3f}"]
+        subprocess.run([
+            "ffmpeg",
+            "-y",
+            "-loglevel", "error",
+            "-ss", f"{bounds[index]:.3f}",
+            *limit,
+            *(["-f", input_format] if input_format else []),
+            "-i", video_path,
+            "-map", "0:a:0",
+            "-vn",
+            *profile["args"],
+            *BITEXACT_ARGS,
+            slice_paths[index]
+        ], check=True, capture_output=True)
+
+    try:
+        with ThreadPoolExecutor(max_workers=slices) as pool:
+            list(pool.map(encode_slice, range(slices)))
+        with open(list_path, "w") as parts:
+            for path in slice_paths:
+                parts.write(f"file '{path}'\n")
         subprocess.run([
-            "ffmpeg", 
-            "-i", video_path, 
-            "-q:a", "0",
-            "-map", "a", 
+            "ffmpeg",
+            "-y",
+            "-loglevel", "error",
+            "-f", "concat",
+            "-safe", "0",
+            "-i", list_path,
+            "-c", "copy",
+            *BITEXACT_ARGS,
             audio_path
         ], check=True, capture_output=True)
-        
-        audio = AudioSegment.from_mp3(audio_path)
-        duration = len(audio) / 1000  # длительность в секундах
-        
-        return audio_path, duration
+    except Exception:
+        if os.path.exists(audio_path):
+            os.remove(audio_path)
+        raise
+    finally:
+        for path in slice_paths + [list_path]:
+            if os.path.exists(path):
+                os.remove(path)
+    return audio_path
+
+def extract_audio_from_pipe(uploaded_file, media, profile_name, chunk_size=None):
+    # Сведения о потоках уже получены при предварительной проверке, ffmpeg получает загрузку через stdin
+    audio_stream = media["audio_stream"]
+    audio_path, mode, ingest = extract_audio_track(
+        None, new_audio_base(), audio_stream, ENCODING_PROFILES[profile_name], uploaded_file, chunk_size,
+        media["demuxer"]
+    )
+    return finish_extraction(audio_path, {
+        "ingest": ingest,
+        "mode": mode,
+        "profile": profile_name,
+        "source_codec": audio_stream.get("codec_name"),
+        "input": "pipe",
+    })
+
+def extract_audio_from_file(uploaded_file, media, profile_name, chunk_size=None):
+    # Видео, сохранённое при предварительной проверке, используется повторно;
+    # иначе сохраняем его потоково, блоками chunk_size байт
+    if media["path"] is None:
+        media["path"], media["ingest"] = save_upload(uploaded_file, media["suffix"], chunk_size)
+    video_path = media["path"]
+    audio_stream = media["audio_stream"]
+    profile = ENCODING_PROFILES[profile_name]
+    slices = get_slice_count(media["duration"], audio_stream, profile)
+    if slices > 1:
+        audio_path = extract_audio_parallel(
+            video_path, new_audio_base(), media["duration"], profile, slices, media["demuxer"]
+        )
+        mode = "transcode"
+    else:
+        audio_path, mode, _ = extract_audio_track(
+            video_path, new_audio_base(), audio_stream, profile, input_format=media["demuxer"]
+        )
+    return finish_extraction(audio_path, {
+        "ingest": media["ingest"],
+        "mode": mode,
+        "profile": profile_name,
+        "slices": slices,
+        "source_codec": audio_stream.get("codec_name"),
+        "input": "file",
+    })
+
+def extract_audio_passthrough(uploaded_file, media, profile_name, chunk_size=None):
+    # Файл, сохранённый при предварительной проверке, уже полностью изучен ffprobe
+    probe = media["probe"] if media["path"] else None
+    if media["path"] is None:
+        media["path"], media["ingest"] = save_upload(uploaded_file, media["suffix"], chunk_size)
+    audio_path = media["path"]
+    meta = {"ingest": media["ingest"], "mode": "passthrough", "profile": profile_name, "input": "file"}
+    # Файл, который укладывается в лимит API, отправляется как есть;
+    # более крупный сжимается профилем, чтобы сократить объём загрузки и число частей
+    if profile_name == "source" or media["size"] <= API_MAX_FILE_SIZE:
+        media["path"] = None  # файл переходит на следующий этап и не удаляется вместе с загрузкой
+        return finish_extraction(audio_path, meta, probe)
+    encoded_path, mode, _ = extract_audio_track(
+        audio_path, new_audio_base(), None, ENCODING_PROFILES[profile_name], input_format=media["demuxer"]
+    )
+    meta.update(mode=mode, source_codec=media["audio_stream"].get("codec_name"))
+    return finish_extraction(encoded_path, meta)
+
+def extract_audio(uploaded_file, media=None, chunk_size=None, extraction_mode=None, profile=None):
+    profile = profile or ENCODING_PROFILE
+    if profile not in ENCODING_PROFILES:
+        st.error(f"Неизвестный профиль кодирования аудио: {profile}")
+        raise ValueError(f"Неизвестный профиль кодирования аудио: {profile}")
+    if media is None:
+        media = preflight_media(uploaded_file, chunk_size)
+    profile = resolve_encoding_profile(profile)
+
+    extraction_mode = extraction_mode or EXTRACTION_MODE
+    try:
+        # Аудиофайлы в формате, который принимает API, передаются на транскрибацию без извлечения дорожки
+        if is_api_ready(media):
+            return extract_audio_passthrough(uploaded_file, media, profile, chunk_size)
+
+        # Длинную запись выгоднее сохранить на диск и кодировать параллельными отрезками
+        use_pipe = media["path"] is None and (
+            extraction_mode == "pipe" or (
+                extraction_mode == "auto"
+                and get_slice_count(media["duration"], media["audio_stream"], ENCODING_PROFILES[profile]) == 1
+            )
+        )
+        if use_pipe:
+            try:
+                return extract_audio_from_pipe(uploaded_file, media, profile, chunk_size)
+            except subprocess.CalledProcessError:
+                # Контейнер не читается из канала — повторяем через временный файл
+                if extraction_mode == "pipe":
+                    raise
+        return extract_audio_from_file(uploaded_file, media, profile, chunk_size)
     except Exception as e:
         st.error(f"Ошибка при извлечении аудио: {str(e)}")
         raise
     finally:
-        if os.path.exists(video_path):
-            os.remove(video_path)
+        discard_media(media)
 
-# ----------------------- Транскрибация аудио -----------------------
-def transcribe_audio(client, audio_file, language='ru'):
+# ----------------------- Кэш транскрипций -----------------------
+# Транскрипции хранятся на диске под ключом из хэша загруженного файла, языка, модели, профиля кодирования
+# и параметров удаления пауз, поэтому кэш проверяется до извлечения аудио. Хранятся таймкоды исходной записи;
+# записи старше TRANSCRIPT_CACHE_MAX_AGE (сек от сохранения) удаляются, при превышении объёма —
+# давно не использованные. Каталог и файлы доступны только владельцу процесса
+TRANSCRIPT_CACHE_ENABLED = get_setting("transcript_cache_enabled", True)
+TRANSCRIPT_CACHE_DIR = get_setting(
+    "transcript_cache_dir", os.path.join(tempfile.gettempdir(), "transcript_cache")
+)
+TRANSCRIPT_CACHE_MAX_BYTES = get_setting("transcript_cache_max_bytes", 512 * 1024 * 1024)
+TRANSCRIPT_CACHE_MAX_AGE = get_setting("transcript_cache_max_age", 24 * 3600.0)
+
+def make_private_dir(path):
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    # Каталог мог остаться от прежней версии с правами по умолчанию
+    os.chmod(path, 0o700)
+
+def hash_file(path, chunk_size=None):
+    digest = hashlib.sha256()
+    buffer = bytearray(chunk_size or UPLOAD_CHUNK_SIZE)
+    with open(path, "rb") as file:
+        while True:
+            read = file.readinto(buffer)
+            if not read:
+                break
+            digest.update(memoryview(buffer)[:read])
+    return digest.hexdigest()
+
+def get_transcript_cache_key(content_hash, language, model, profile, vad=None):
+    # content_hash — SHA-256 загрузки; vad — параметры удаления пауз (None — паузы не удаляются)
+    return hashlib.sha256(f"{content_hash}|{language}|{model}|{profile}|{vad or 'vad:off'}".encode()).hexdigest()
+
+def get_transcript_cache_path(key):
+    return os.path.join(TRANSCRIPT_CACHE_DIR, key + ".json")
+
+def load_cached_transcript(key):
+    path = get_transcript_cache_path(key)
+    try:
+        # mtime — время сохранения (для срока хранения), atime — последнего обращения (для вытеснения LRU)
+        stat = os.stat(path)
+        if stat.st_mtime < time.time() - TRANSCRIPT_CACHE_MAX_AGE:
+            os.remove(path)
+            return None
+        with open(path, "r", encoding="utf-8") as file:
+            data = json.load(file)
+        os.utime(path, (time.time(), stat.st_mtime))
+        return data
+    except (OSError, ValueError):
+        return None
+
+def lookup_cached_transcript(key):
+    # Просроченные записи удаляются при каждом обращении к кэшу, а не только при сохранении
+    evict_transcript_cache()
+    cached = load_cached_transcript(key)
+    return Transcript.from_dict(cached) if cached is not None else None
+
+def write_json_atomic(path, data):
+    # Запись через временный файл и os.replace: параллельные сессии не увидят недописанный файл
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), "w", encoding="utf-8") as file:
+        json.dump(data, file, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def store_cached_transcript(key, data):
+    try:
+        make_private_dir(TRANSCRIPT_CACHE_DIR)
+        write_json_atomic(get_transcript_cache_path(key), data)
+        evict_transcript_cache()
+    except OSError:
+        pass
+
+def evict_transcript_cache():
+    entries = []
+    deadline = time.time() - TRANSCRIPT_CACHE_MAX_AGE
+    try:
+        scan = list(os.scandir(TRANSCRIPT_CACHE_DIR))
+    except OSError:
+        return
+    for entry in scan:
+        if entry.name.endswith(".json"):
+            try:
+                stat = entry.stat()
+            except OSError:
+                # Файл уже удалила другая сессия или поток
+                continue
+            if stat.st_mtime < deadline:
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+                continue
+            entries.append((max(stat.st_atime, stat.st_mtime), stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= TRANSCRIPT_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+# ----------------------- Контрольные точки транскрибации -----------------------
+# Результат каждой готовой части длинной записи сохраняется на диск под тем же ключом, что и кэш.
+# Повторная отправка того же аудио после обрыва сессии или перезапуска продолжает с недостающих частей.
+# Для переживания перезапуска пода каталог должен быть на постоянном томе.
+# Каталоги и файлы доступны только владельцу процесса
+TRANSCRIBE_CHECKPOINTS = get_setting("transcribe_checkpoints", True)
+CHECKPOINT_DIR = get_setting(
+    "checkpoint_dir", os.path.join(tempfile.gettempdir(), "transcript_checkpoints")
+)
+# Незавершённые контрольные точки старше этого срока (сек) удаляются
+CHECKPOINT_MAX_AGE = get_setting("checkpoint_max_age", 7 * 24 * 3600.0)
+
+def get_checkpoint_dir(key):
+    return os.path.join(CHECKPOINT_DIR, key)
+
+def get_checkpoint_chunk_path(key, index):
+    return os.path.join(get_checkpoint_dir(key), f"chunk_{index:05d}.json")
+
+def load_checkpoint(key):
+    # План частей и уже готовые части {номер: Transcript}; (None, {}) — контрольной точки нет
     try:
+        with open(os.path.join(get_checkpoint_dir(key), "plan.json"), "r", encoding="utf-8") as file:
+            chunks = [tuple(chunk) for chunk in json.load(file)["chunks"]]
+    except (OSError, ValueError, KeyError):
+        return None, {}
+    done = {}
+    for index in range(len(chunks)):
+        try:
+            with open(get_checkpoint_chunk_path(key, index), "r", encoding="utf-8") as file:
+                done[index] = Transcript.from_dict(json.load(file))
+        except (OSError, ValueError, KeyError):
+            continue
+    return chunks, done
+
+def save_checkpoint_plan(key, chunks):
+    # План сохраняется, чтобы при возобновлении границы частей совпали с уже готовыми
+    try:
+        make_private_dir(CHECKPOINT_DIR)
+        make_private_dir(get_checkpoint_dir(key))
+        write_json_atomic(os.path.join(get_checkpoint_dir(key), "plan.json"), {"chunks": chunks})
+    except OSError:
+        pass
+
+def save_checkpoint_chunk(key, index, transcript):
+    try:
+        write_json_atomic(get_checkpoint_chunk_path(key, index), transcript.to_dict())
+    except OSError:
+        pass
+
+def remove_checkpoint(key):
+    shutil.rmtree(get_checkpoint_dir(key), ignore_errors=True)
+
+def cleanup_stale_checkpoints():
+    try:
+        entries = list(os.scandir(CHECKPOINT_DIR))
+    except OSError:
+        return
+    deadline = time.time() - CHECKPOINT_MAX_AGE
+    for entry in entries:
+        try:
+            if entry.is_dir() and entry.stat().st_mtime < deadline:
+                shutil.rmtree(entry.path, ignore_errors=True)
+        except OSError:
+            pass
+
+# ----------------------- Транскрипт с таймкодами -----------------------
+class Transcript:
+    # Сегменты хранятся по столбцам: массивы начала и конца (сек) и смещения в одном текстовом буфере.
+    # Многочасовая запись с десятками тысяч сегментов занимает немногим больше самого текста,
+    # а поиск текста по времени — двоичный поиск по массиву.
+    # Сегмент i — text[offsets[i]:offsets[i + 1] - 1] (сегменты разделены одним пробелом)
+    __slots__ = ("text", "starts", "ends", "offsets")
+
+    def __init__(self, text, starts, ends, offsets):
+        self.text = text
+        self.starts = starts
+        self.ends = ends
+        self.offsets = offsets
+
+    @classmethod
+    def from_segments(cls, segments):
+        # segments — последовательность (начало, конец, текст)
+        texts, starts, ends = [], [], []
+        for start, end, text in segments:
+            text = (text or "").strip()
+            if text:
+                texts.append(text)
+                starts.append(start)
+                ends.append(end)
+        offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(text) + 1 for text in texts])
+        return cls(
+            " ".join(texts),
+            np.asarray(starts, dtype=np.float32),
+            np.asarray(ends, dtype=np.float32),
+            offsets,
+        )
+
+    @classmethod
+    def from_dict(cls, data):
+        if "starts" not in data:
+            return cls.from_segments([(0.0, 0.0, data["text"])])
+        return cls(
+            data["text"],
+            np.asarray(data["starts"], dtype=np.float32),
+            np.asarray(data["ends"], dtype=np.float32),
+            np.asarray(data["offsets"], dtype=np.int64),
+        )
+
+    def to_dict(self):
+        return {
+            "text": self.text,
+            "starts": self.starts.tolist(),
+            "ends": self.ends.tolist(),
+            "offsets": self.offsets.tolist(),
+        }
+
+    def __len__(self):
+        return len(self.starts)
+
+    def segment_text(self, index):
+        return self.text[self.offsets[index]:self.offsets[index + 1] - 1]
+
+    def segments(self):
+        for index in range(len(self)):
+            yield float(self.starts[index]), float(self.ends[index]), self.segment_text(index)
+
+    def text_at(self, seconds):
+        # Сегмент, который звучит в момент seconds
+        index = int(np.searchsorted(self.starts, seconds, side="right")) - 1
+        if index < 0 or seconds > self.ends[index]:
+            return ""
+        return self.segment_text(index)
+
+    def text_between(self, start, end):
+        # Текст сегментов, пересекающихся с интервалом [start, end]
+        first = int(np.searchsorted(self.ends, start, side="left"))
+        last = int(np.searchsorted(self.starts, end, side="right"))
+        if last <= first:
+            return ""
+        return self.text[self.offsets[first]:self.offsets[last] - 1]
+
+def format_timestamp(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+def format_timed_transcript(transcript):
+    return "\n".join(
+        f"[{format_timestamp(start)}] {text}" for start, _, text in transcript.segments()
+    )
+
+# ----------------------- Движки транскрибации -----------------------
+# "openai" — API whisper-1, "local" — faster-whisper на CPU (int8) для площадок без доступа к API
+TRANSCRIBE_BACKEND = get_setting("transcribe_backend", "openai")
+LOCAL_WHISPER_MODEL = get_setting("local_whisper_model", "small")
+LOCAL_WHISPER_COMPUTE_TYPE = get_setting("local_whisper_compute_type", "int8")
+LOCAL_WHISPER_THREADS = get_setting("local_whisper_threads", os.cpu_count() or 1)
+# Ограничение API на размер одной части с запасом
+API_SAFE_FILE_SIZE = int(API_MAX_FILE_SIZE * 0.9)
+
+def load_openai_engine(client):
+    return client
+
+def transcribe_file_openai(client, audio_file, language):
+    # Файл открывается заново при каждой попытке, чтобы повтор отправлял его с начала
+    def request():
         with open(audio_file, "rb") as file:
-            transcript = client.audio.transcriptions.create(
+            return client.audio.transcriptions.create(
                 model="whisper-1",
                 file=file,
-                language=language
+                language=language,
+                response_format="verbose_json",
+                timestamp_granularities=["segment"]
             )
-        return transcript.text
+    response = call_with_retry(request)
+    segments = getattr(response, "segments", None)
+    if not segments:
+        return Transcript.from_segments([(0.0, float(getattr(response, "duration", 0) or 0), response.text)])
+    return Transcript.from_segments((segment.start, segment.end, segment.text) for segment in segments)
+
+@st.cache_resource(show_spinner=False)
+def load_local_whisper_model(model_name, compute_type, threads):
+    # Модель загружается один раз на процесс; пакет нужен только там, где выбран локальный движок
+    try:
+        from faster_whisper import WhisperModel
+    except ImportError:
+        raise RuntimeError("Локальный движок транскрибации недоступен: установите пакет faster-whisper.")
+    return WhisperModel(model_name, device="cpu", compute_type=compute_type, cpu_threads=threads)
+
+def load_local_engine(client):
+    return load_local_whisper_model(LOCAL_WHISPER_MODEL, LOCAL_WHISPER_COMPUTE_TYPE, LOCAL_WHISPER_THREADS)
+
+def transcribe_file_local(model, audio_file, language):
+    segments, _ = model.transcribe(audio_file, language=language)
+    return Transcript.from_segments((segment.start, segment.end, segment.text) for segment in segments)
+
+# Все движки принимают (движок, путь к файлу, язык) и возвращают Transcript.
+# max_file_size — лимит на размер части (None — без лимита),
+# concurrency — число одновременных частей (None — TRANSCRIBE_CONCURRENCY)
+TRANSCRIPTION_BACKENDS = {
+    "openai": {
+        "model": "whisper-1",
+        "load": load_openai_engine,
+        "transcribe": transcribe_file_openai,
+        "max_file_size": API_SAFE_FILE_SIZE,
+        "concurrency": None,
+    },
+    "local": {
+        "model": f"faster-whisper-{LOCAL_WHISPER_MODEL}-{LOCAL_WHISPER_COMPUTE_TYPE}",
+        "load": load_local_engine,
+        "transcribe": transcribe_file_local,
+        "max_file_size": None,
+        # Локальная модель и так занимает все ядра, параллельные части только мешают друг другу
+        "concurrency": 1,
+    },
+}
+
+def get_transcription_backend(name=None):
+    name = name or TRANSCRIBE_BACKEND
+    if name not in TRANSCRIPTION_BACKENDS:
+        raise ValueError(f"Неизвестный движок транскрибации: {name}")
+    return TRANSCRIPTION_BACKENDS[name]
+
+# ----------------------- Транскрибация аудио -----------------------
+# Длинная запись транскрибируется частями: длительность части (сек) и перекрытие соседних частей (сек)
+TRANSCRIBE_CHUNK_SECONDS = get_setting("transcribe_chunk_seconds", 600.0)
+TRANSCRIBE_CHUNK_OVERLAP = get_setting("transcribe_chunk_overlap", 2.0)
+# Сколько слов на стыке частей сравнивается при удалении повторов
+MAX_OVERLAP_WORDS = 30
+# Сколько частей одной записи отправляется в API одновременно
+TRANSCRIBE_CONCURRENCY = get_setting("transcribe_concurrency", 4)
+
+# Границы частей ставятся в паузах: частота декодирования PCM (Гц), окно RMS и сглаживания (сек),
+# насколько раньше целевой границы можно искать паузу (сек) и уровень паузы относительно медианы
+SILENCE_ALIGNED_CHUNKS = get_setting("silence_aligned_chunks", True)
+SILENCE_SAMPLE_RATE = 8000
+SILENCE_WINDOW = 0.05
+SILENCE_SMOOTHING = 0.3
+SILENCE_SEARCH_TOLERANCE = get_setting("silence_search_tolerance", 30.0)
+SILENCE_RELATIVE_LEVEL = 0.3
+
+def get_chunk_seconds(duration, file_size, max_file_size=API_SAFE_FILE_SIZE):
+    # Длина части такая, чтобы файл части с перекрытием гарантированно укладывался в лимит движка
+    # (max_file_size=None — лимита нет); None — запись отправляется целиком
+    if duration <= 0:
+        return None
+    if duration <= TRANSCRIBE_CHUNK_SECONDS and (max_file_size is None or file_size <= max_file_size):
+        return None
+    if max_file_size is None:
+        return TRANSCRIBE_CHUNK_SECONDS
+    bytes_per_second = file_size / duration
+    return min(
+        TRANSCRIBE_CHUNK_SECONDS,
+        max_file_size / bytes_per_second - TRANSCRIBE_CHUNK_OVERLAP,
+    )
+
+def compute_rms_envelope(audio_path, sample_rate=SILENCE_SAMPLE_RATE, window=SILENCE_WINDOW, pcm_file=None):
+    # ffmpeg декодирует запись в моно PCM низкой частоты, RMS считается векторно по окнам.
+    # Поток читается блоками, поэтому в памяти остаётся только огибающая, а не вся запись;
+    # если передан pcm_file, декодированный PCM дописывается в него для повторного использования
+    window_bytes = int(sample_rate * window) * 2
+    block_size = window_bytes * 1200
+    command = [
+        "ffmpeg",
+        "-loglevel", "error",
+        "-i", audio_path,
+        "-map", "0:a:0",
+        "-ac", "1",
+        "-ar", str(sample_rate),
+        "-f", "s16le",
+        "pipe:1"
+    ]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    envelope = []
+    remainder = b""
+    with process.stdout:
+        while True:
+            block = process.stdout.read(block_size)
+            if not block:
+                break
+            if pcm_file is not None:
+                pcm_file.write(block)
+            data = remainder + block
+            usable = len(data) - len(data) % window_bytes
+            remainder = data[usable:]
+            samples = np.frombuffer(data[:usable], dtype="<i2").astype(np.float32)
+            frames = samples.reshape(-1, window_bytes // 2)
+            envelope.append(np.sqrt(np.mean(frames * frames, axis=1)))
+    if process.wait() != 0:
+        raise subprocess.CalledProcessError(process.returncode, command)
+    return np.concatenate(envelope) if envelope else np.zeros(0, dtype=np.float32)
+
+def find_pause_cuts(envelope, duration, chunk_seconds, window=SILENCE_WINDOW):
+    # Для каждой целевой границы ищем самое тихое место в окне допуска перед ней
+    # (не позже, чтобы часть не превысила лимит). Возвращает [(время, попала ли граница в паузу)]
+    smoothing = max(1, int(SILENCE_SMOOTHING / window))
+    energy = np.convolve(envelope, np.ones(smoothing) / smoothing, mode="same")
+    threshold = float(np.median(energy)) * SILENCE_RELATIVE_LEVEL if len(energy) else 0.0
+    cuts = []
+    position = 0.0
+    while duration - position > chunk_seconds:
+        target = position + chunk_seconds
+        low = int(max(position + 1.0, target - SILENCE_SEARCH_TOLERANCE) / window)
+        high = min(int(target / window), len(energy))
+        if high <= low:
+            cuts.append((target, False))
+            position = target
+            continue
+        index = low + int(np.argmin(energy[low:high]))
+        cut = index * window
+        cuts.append((cut, bool(energy[index] <= threshold)))
+        position = cut
+    return cuts
+
+def plan_chunks(duration, file_size, audio_path=None, max_file_size=API_SAFE_FILE_SIZE):
+    # Части (начало, конец) в секундах. Если граница попала в паузу, перекрытие не нужно;
+    # иначе часть начинается на перекрытие раньше, чтобы слово на стыке целиком попало в одну из частей.
+    # Последняя часть не ограничена (конец None): длительность из метаданных бывает занижена,
+    # например у MP3 с переменным битрейтом без заголовка Xing
+    chunk_seconds = get_chunk_seconds(duration, file_size, max_file_size)
+    if chunk_seconds is None:
+        return [(0.0, None)]
+
+    cuts = None
+    if audio_path and SILENCE_ALIGNED_CHUNKS:
+        try:
+            cuts = find_pause_cuts(compute_rms_envelope(audio_path), duration, chunk_seconds)
+        except (subprocess.CalledProcessError, OSError):
+            cuts = None
+    if cuts is None:
+        count = int(math.ceil(duration / chunk_seconds))
+        cuts = [(chunk_seconds * index, False) for index in range(1, count)]
+
+    chunks = []
+    start = 0.0
+    overlap = 0.0
+    for cut, in_pause in cuts + [(None, True)]:
+        chunks.append((max(0.0, start - overlap), cut))
+        overlap = 0.0 if in_pause else TRANSCRIBE_CHUNK_OVERLAP
+        start = cut
+    return chunks
+
+def cut_audio_chunk(audio_path, start, end):
+    # Часть вырезается без перекодирования; end=None — до конца файла
+    chunk_path = f"{os.path.splitext(audio_path)[0]}_{int(start * 1000):09d}{os.path.splitext(audio_path)[1]}"
+    limit = [] if end is None else ["-t", f"{end - start:.3f}"]
+    subprocess.run([
+        "ffmpeg",
+        "-y",
+        "-loglevel", "error",
+        "-ss", f"{start:.3f}",
+        *limit,
+        "-i", audio_path,
+        "-map", "0:a:0",
+        "-c", "copy",
+        chunk_path
+    ], check=True, capture_output=True)
+    return chunk_path
+
+def has_audio_packets(audio_path):
+    # Читается только первый пакет дорожки: при завышенной длительности последняя часть
+    # может оказаться пустой, и отправлять её на транскрибацию не нужно
+    output = run_tool([
+        "ffprobe",
+        "-v", "error",
+        "-select_streams", "a:0",
+        "-read_intervals", "%+#1",
+        "-show_entries", "packet=pts_time",
+        "-of", "csv=p=0",
+        audio_path
+    ])
+    return bool(output and output.strip())
+
+def normalize_word(word):
+    return word.strip(string.punctuation + "«»„“”—–…").lower()
+
+def merge_overlapping_text(previous, current):
+    # Удаляем из начала текущей части слова, которые уже прозвучали в конце предыдущей:
+    # ищем самое длинное совпадение конца предыдущего текста с началом текущего
+    previous_words = [normalize_word(word) for word in previous.split()[-MAX_OVERLAP_WORDS:]]
+    current_words = current.split()
+    current_normalized = [normalize_word(word) for word in current_words[:MAX_OVERLAP_WORDS]]
+    for size in range(min(len(previous_words), len(current_normalized)), 0, -1):
+        if previous_words[-size:] != current_normalized[:size]:
+            continue
+        # Совпадение в одно короткое слово («и», «в») скорее случайно
+        if size == 1 and len(current_normalized[0]) < 4:
+            break
+        return " ".join(current_words[size:])
+    return current
+
+def stitch_transcripts(parts):
+    # parts — [(Transcript со временем от начала записи, начало части без перекрытия, конец части)].
+    # Из каждой части берутся сегменты, пересекающиеся с её собственным интервалом: сегмент на стыке
+    # может попасть в обе части, и слова, повторно распознанные на стыке, удаляются сравнением текста.
+    # Отбрасывать такой сегмент по времени нельзя — его слова после стыка могут больше нигде не прозвучать
+    segments = []
+    text = ""
+    for transcript, keep_from, keep_to in parts:
+        first = True
+        for start, end, segment in transcript.segments():
+            if end <= keep_from or start >= keep_to:
+                continue
+            if first and text:
+                # Сегмент, целиком повторивший конец предыдущей части, пропускается, сравнение продолжается
+                segment = merge_overlapping_text(text, segment)
+                if not segment:
+                    continue
+            first = False
+            segments.append((start, end, segment))
+            text = f"{text} {segment}" if text else segment
+    return Transcript.from_segments(segments)
+
+def shift_transcript(transcript, seconds):
+    return Transcript(transcript.text, transcript.starts + seconds, transcript.ends + seconds, transcript.offsets)
+
+def transcribe_chunk_range(backend, engine, audio_file, start, end, language):
+    # Таймкоды части пересчитываются от начала всей записи
+    chunk_path = cut_audio_chunk(audio_file, start, end)
+    try:
+        if not has_audio_packets(chunk_path):
+            return Transcript.from_segments([])
+        return shift_transcript(backend["transcribe"](engine, chunk_path, language), start)
+    finally:
+        if os.path.exists(chunk_path):
+            os.remove(chunk_path)
+
+def transcribe_chunks(backend, engine, audio_file, language, duration, concurrency, checkpoint_key=None,
+                      on_progress=None):
+    chunks, done = load_checkpoint(checkpoint_key) if checkpoint_key else (None, {})
+    if chunks is None:
+        if duration is None:
+            duration = get_audio_info(audio_file)["duration"]
+        chunks = plan_chunks(duration, os.path.getsize(audio_file), audio_file, backend["max_file_size"])
+        if checkpoint_key and len(chunks) > 1:
+            save_checkpoint_plan(checkpoint_key, chunks)
+    if len(chunks) == 1:
+        transcript = backend["transcribe"](engine, audio_file, language)
+        if on_progress:
+            on_progress(transcript, 1, 1)
+        return transcript
+
+    def transcribe_part(index, start, end):
+        transcript = transcribe_chunk_range(backend, engine, audio_file, start, end, language)
+        if checkpoint_key:
+            save_checkpoint_chunk(checkpoint_key, index, transcript)
+        return transcript
+
+    # Собственный интервал части: от конца предыдущей до своего конца (последняя — до конца записи)
+    bounds = [0.0] + [end for _, end in chunks[:-1]] + [math.inf]
+
+    def stitch(transcripts):
+        return stitch_transcripts(
+            (transcript, bounds[index], bounds[index + 1]) for index, transcript in enumerate(transcripts)
+        )
+
+    # Части обрабатываются пулом с ограничением числа одновременных запросов,
+    # результаты собираются в исходном порядке; готовые по контрольной точке части не отправляются.
+    # Результаты ожидаются по порядку, поэтому on_progress получает растущее начало транскрипта
+    # и вызывается в вызывающем потоке
+    workers = max(1, min(backend["concurrency"] or concurrency or TRANSCRIBE_CONCURRENCY, len(chunks)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            index: pool.submit(transcribe_part, index, start, end)
+            for index, (start, end) in enumerate(chunks)
+            if index not in done
+        }
+        transcripts = []
+        try:
+            for index in range(len(chunks)):
+                transcripts.append(done[index] if index in done else futures[index].result())
+                if on_progress:
+                    on_progress(stitch(transcripts), index + 1, len(chunks))
+        except Exception:
+            for future in futures.values():
+                future.cancel()
+            raise
+    return stitch(transcripts)
+
+def transcribe_audio(client, audio_file, language='ru', duration=None, concurrency=None, profile=None,
+                     backend=None, on_progress=None, time_map=None, cache_key=None):
+    try:
+        backend = get_transcription_backend(backend)
+        # Одинаковый материал с теми же языком, моделью и профилем кодирования не транскрибируется повторно,
+        # а прерванная транскрибация продолжается с контрольной точки. cache_key — ключ по хэшу загрузки
+        # (см. get_transcript_cache_key); без него ключ считается по самому аудио
+        key = cache_key
+        if key is None and (TRANSCRIPT_CACHE_ENABLED or TRANSCRIBE_CHECKPOINTS):
+            key = get_transcript_cache_key(hash_file(audio_file), language, backend["model"], profile)
+        if TRANSCRIPT_CACHE_ENABLED:
+            transcript = lookup_cached_transcript(key)
+            if transcript is not None:
+                if on_progress:
+                    on_progress(transcript, 1, 1)
+                return transcript
+
+        checkpoint_key = key if TRANSCRIBE_CHECKPOINTS else None
+        if checkpoint_key:
+            cleanup_stale_checkpoints()
+
+        # Движок загружается один раз в вызывающем потоке и передаётся рабочим потокам
+        engine = backend["load"](client)
+        transcript = transcribe_chunks(
+            backend, engine, audio_file, language, duration, concurrency, checkpoint_key, on_progress
+        )
+        # Таймкоды записи без пауз пересчитываются в исходную шкалу времени; в кэш попадают уже они
+        if time_map:
+            transcript = map_transcript_times(transcript, time_map)
+        if TRANSCRIPT_CACHE_ENABLED:
+            store_cached_transcript(key, transcript.to_dict())
+        if checkpoint_key:
+            remove_checkpoint(checkpoint_key)
+        return transcript
     except Exception as e:
         st.error(f"Ошибка при транскрибации: {str(e)}")
         raise
@@ -157,8 +1488,291 @@ def transcribe_audio(client, audio_file, language='ru'):
         if os.path.exists(audio_file):
             os.remove(audio_file)
 
+# ----------------------- Удаление пауз (VAD) -----------------------
+# Необязательный этап между извлечением и транскрибацией: участки без речи вырезаются по энергии сигнала.
+# Речь — окна, где сглаженная RMS выше уровня шума (10-й перцентиль) в VAD_NOISE_FACTOR раз;
+# вырезаются только паузы длиннее VAD_MIN_SILENCE (сек), к речи добавляется запас VAD_PADDING (сек)
+VAD_ENABLED = get_setting("vad_enabled", False)
+VAD_NOISE_FACTOR = get_setting("vad_noise_factor", 3.0)
+VAD_MIN_LEVEL = 100.0
+VAD_MIN_SILENCE = get_setting("vad_min_silence", 2.0)
+VAD_PADDING = get_setting("vad_padding", 0.3)
+# Если речь занимает большую долю записи, перекодирование не окупается
+VAD_MAX_SPEECH_RATIO = 0.9
+# Частота PCM для анализа и вырезания пауз: запись без пауз кодируется из него (моно 16 кГц, как в речевых профилях)
+VAD_SAMPLE_RATE = 16000
+
+def find_speech_intervals(envelope, duration, window=SILENCE_WINDOW):
+    if not len(envelope):
+        return [[0.0, duration]]
+    smoothing = max(1, int(SILENCE_SMOOTHING / window))
+    energy = np.convolve(envelope, np.ones(smoothing) / smoothing, mode="same")
+    threshold = max(float(np.percentile(energy, 10)) * VAD_NOISE_FACTOR, VAD_MIN_LEVEL)
+    speech = np.concatenate(([False], energy > threshold, [False]))
+    changes = np.flatnonzero(speech[1:] != speech[:-1])
+    intervals = []
+    for start, end in zip(changes[0::2] * window, changes[1::2] * window):
+        start = max(0.0, float(start) - VAD_PADDING)
+        end = min(duration, float(end) + VAD_PADDING)
+        if intervals and start - intervals[-1][1] < VAD_MIN_SILENCE:
+            intervals[-1][1] = end
+        else:
+            intervals.append([start, end])
+    return intervals
+
+def get_vad_signature():
+    # Параметры, от которых зависит запись без пауз, входят в ключ кэша транскрипций
+    return (
+        f"vad:{VAD_NOISE_FACTOR}:{VAD_MIN_LEVEL}:{VAD_MIN_SILENCE}:{VAD_PADDING}:"
+        f"{VAD_MAX_SPEECH_RATIO}:{VAD_SAMPLE_RATE}"
+    )
+
+def map_to_source_time(time_map, seconds):
+    # Время в записи без пауз -> время в исходной записи (seconds — число или массив)
+    index = np.searchsorted(time_map["output_starts"], seconds, side="right") - 1
+    index = np.clip(index, 0, len(time_map["output_starts"]) - 1)
+    return time_map["source_starts"][index] + (seconds - time_map["output_starts"][index])
+
+def map_transcript_times(transcript, time_map):
+    return Transcript(
+        transcript.text,
+        map_to_source_time(time_map, transcript.starts).astype(np.float32),
+        map_to_source_time(time_map, transcript.ends).astype(np.float32),
+        transcript.offsets,
+    )
+
+def write_pcm_ranges(pcm_path, ranges, output_path, profile):
+    # Оставленные диапазоны отсчётов подаются одному кодировщику через stdin за один линейный проход
+    command = [
+        "ffmpeg",
+        "-y",
+        "-loglevel", "error",
+        "-f", "s16le",
+        "-ar", str(VAD_SAMPLE_RATE),
+        "-ac", "1",
+        "-i", "pipe:0",
+        *profile["args"],
+        *BITEXACT_ARGS,
+        output_path
+    ]
+    pcm = np.memmap(pcm_path, dtype="<i2", mode="r")
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    def write_input():
+        try:
+            for start, end in ranges:
+                for block in range(start, min(end, len(pcm)), UPLOAD_CHUNK_SIZE // 2):
+                    process.stdin.write(pcm[block:min(end, block + UPLOAD_CHUNK_SIZE // 2)].tobytes())
+        except BrokenPipeError:
+            pass
+        finally:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    writer = threading.Thread(target=write_input, daemon=True)
+    writer.start()
+    stderr = process.stderr.read()
+    process.wait()
+    writer.join()
+    del pcm
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command, stderr=stderr)
+
+def remove_silence(audio_path, meta):
+    # Возвращает путь к записи без пауз и метаданные с новой длительностью и картой времени
+    # (time_map) для пересчёта таймкодов в исходную запись; без изменений, если вырезать нечего.
+    # Запись декодируется один раз: PCM, по которому считается огибающая, сохраняется во временный файл,
+    # и из него паузы вырезаются с точностью до отсчёта
+    output_path = None
+    pcm_path = new_audio_base() + ".pcm"
+    try:
+        with open(pcm_path, "wb") as pcm_file:
+            envelope = compute_rms_envelope(audio_path, VAD_SAMPLE_RATE, pcm_file=pcm_file)
+        intervals = find_speech_intervals(envelope, meta["duration"])
+        speech = sum(end - start for start, end in intervals)
+        if not intervals or speech >= meta["duration"] * VAD_MAX_SPEECH_RATIO:
+            return audio_path, meta
+
+        samples = [(round(start * VAD_SAMPLE_RATE), round(end * VAD_SAMPLE_RATE)) for start, end in intervals]
+        profile = ENCODING_PROFILES[meta["profile"]]
+        output_path = new_audio_base() + profile["ext"]
+        write_pcm_ranges(pcm_path, samples, output_path, profile)
+        # Длительность читается из результата, а не складывается из интервалов
+        info = get_audio_info(output_path)
+    except Exception as e:
+        for path in (audio_path, output_path):
+            if path and os.path.exists(path):
+                os.remove(path)
+        st.error(f"Ошибка при удалении пауз: {str(e)}")
+        raise
+    finally:
+        if os.path.exists(pcm_path):
+            os.remove(pcm_path)
+
+    os.remove(audio_path)
+    source_starts = np.asarray([start for start, _ in samples], dtype=np.float64) / VAD_SAMPLE_RATE
+    lengths = np.asarray([end - start for start, end in samples], dtype=np.float64) / VAD_SAMPLE_RATE
+    output_starts = np.concatenate(([0.0], np.cumsum(lengths)[:-1]))
+    return output_path, {
+        **meta,
+        "duration": info["duration"] or float(lengths.sum()),
+        "sample_rate": info["sample_rate"],
+        "channels": info["channels"],
+        "source_duration": meta["duration"],
+        "time_map": {"source_starts": source_starts, "output_starts": output_starts},
+    }
+
+# ----------------------- Подсчёт токенов -----------------------
+# Токены считаются локально токенизатором модели (tiktoken, кодировка gpt-4o-mini);
+# если пакет или его словарь недоступны, используется оценка по длине текста.
+# Словарь tiktoken при первом обращении скачивает из сети, поэтому он используется только
+# из заранее заполненного каталога кэша (TIKTOKEN_CACHE_DIR); без файла словаря сеть не трогается
+TOKENIZER_ENCODING = "o200k_base"
+TOKENIZER_URL = "https://openaipublic.blob.core.windows.net/encodings/o200k_base.tiktoken"
+# Каталог заполняется при развёртывании, см. tokenizer/README.md
+TIKTOKEN_CACHE_DIR = get_setting(
+    "tiktoken_cache_dir", os.path.join(os.path.dirname(os.path.abspath(__file__)), "tokenizer")
+)
+# Текст до этого объёма отправляется одним запросом, длиннее — по фрагментам
+DIRECT_INPUT_TOKENS = get_setting("direct_input_tokens", 60000)
+SECTION_TOKENS = get_setting("section_tokens", 20000)
+ANALYSIS_CONCURRENCY = get_setting("analysis_concurrency", 4)
+
+# Ограничение длины ответа модели по задачам
+TASK_MAX_TOKENS = {
+    "summary": 1500,
+    "section_summary": 800,
+    "sequence": 1500,
+    "key_facts": 1500,
+    "combined": 4000,
+    "contradictions": 2000,
+    "questions": 1500,
+}
+TASK_LABELS = {
+    "summary": "Суммаризация",
+    "section_summary": "Суммаризация фрагментов",
+    "sequence": "Анализ последовательности",
+    "key_facts": "Ключевые факты",
+    "combined": "Совмещённый анализ",
+    "contradictions": "Противоречия",
+    "questions": "Вопросы",
+}
+
+TOKEN_USAGE_LOCK = threading.Lock()
+
+@st.cache_resource(show_spinner=False)
+def load_tokenizer(encoding_name):
+    # tiktoken ищет словарь в кэше по SHA-1 от его адреса
+    cache_file = os.path.join(TIKTOKEN_CACHE_DIR, hashlib.sha1(TOKENIZER_URL.encode()).hexdigest())
+    if not TIKTOKEN_CACHE_DIR or not os.path.isfile(cache_file):
+        return None
+    os.environ["TIKTOKEN_CACHE_DIR"] = TIKTOKEN_CACHE_DIR
+    try:
+        import tiktoken
+        return tiktoken.get_encoding(encoding_name)
+    except Exception:
+        return None
+
+def count_tokens(text):
+    tokenizer = load_tokenizer(TOKENIZER_ENCODING)
+    if tokenizer is None:
+        # Около трёх символов на токен для русского текста
+        return len(text) // 3 + 1
+    return len(tokenizer.encode(text, disallowed_special=()))
+
+def split_text_sections(text, max_tokens):
+    # Разбиение по границам предложений; слишком длинное предложение делится по словам
+    sections, current, current_tokens = [], [], 0
+    for sentence in re.split(r"(?<=[.!?…])\s+", text.strip()):
+        pieces = [sentence]
+        sentence_tokens = count_tokens(sentence)
+        if sentence_tokens > max_tokens:
+            words = sentence.split()
+            step = max(1, len(words) * max_tokens // sentence_tokens)
+            pieces = [" ".join(words[i:i + step]) for i in range(0, len(words), step)]
+        for piece in pieces:
+            tokens = count_tokens(piece)
+            if current and current_tokens + tokens > max_tokens:
+                sections.append(" ".join(current))
+                current, current_tokens = [], 0
+            current.append(piece)
+            current_tokens += tokens
+    if current:
+        sections.append(" ".join(current))
+    return sections
+
+def reset_token_usage():
+    st.session_state["token_usage"] = {}
+
+def record_token_usage(task, counted_tokens, usage):
+    with TOKEN_USAGE_LOCK:
+        totals = st.session_state.setdefault("token_usage", {}).setdefault(
+            task, {"requests": 0, "counted": 0, "prompt": 0, "completion": 0}
+        )
+        totals["requests"] += 1
+        totals["counted"] += counted_tokens
+        if usage is not None:
+            totals["prompt"] += usage.prompt_tokens
+            totals["completion"] += usage.completion_tokens
+
+def request_completion(client, task, instruction, prompt, temperature=0.5, **kwargs):
+    # Единая точка запросов к модели: подсчёт входа, ограничение ответа и учёт расхода токенов
+    counted_tokens = count_tokens(instruction) + count_tokens(prompt)
+    response = call_with_retry(
+        client.chat.completions.create,
+        model="gpt-4o-mini",
+        messages=[
+            {"role": "developer", "content": instruction},
+            {"role": "user", "content": prompt}
+        ],
+        temperature=temperature,
+        max_tokens=TASK_MAX_TOKENS[task],
+        **kwargs,
+    )
+    record_token_usage(task, counted_tokens, response.usage)
+    return response.choices[0].message
+
+def map_parallel(function, items):
+    with ThreadPoolExecutor(max_workers=max(1, min(ANALYSIS_CONCURRENCY, len(items)))) as pool:
+        futures = [pool.submit(with_script_run_ctx(function), item) for item in items]
+        return [future.result() for future in futures]
+
+def join_section_results(results):
+    return "\n\n".join(f"Фрагмент {index + 1}:\n{result}" for index, result in enumerate(results))
+
 # ----------------------- Функции для обработки текста -----------------------
 # Здесь мы добавляем контекст следственных действий и роль следствия при установлении достоверности показаний.
+# Каждая функция выбирает способ обработки по числу токенов: текст целиком, по фрагментам
+# или суммаризация по частям с последующим объединением (map-reduce)
+
+SUMMARY_INSTRUCTION = "Вы действуете как опытный следователь, оценивающий достоверность показаний."
+
+def summarize_sections(client, text, language):
+    sections = split_text_sections(text, SECTION_TOKENS)
+    prompts = [
+        f"В рамках следственных действий установите достоверность показаний. Суммируйте фрагмент {index + 1} "
+        f"из {len(sections)} показаний на языке {language}:\n\n"
+        f"{section}\n\n"
+        "Сохраните существенные для следствия факты, даты, имена и последовательность событий."
+        for index, section in enumerate(sections)
+    ]
+    partial = map_parallel(
+        lambda prompt: request_completion(client, "section_summary", SUMMARY_INSTRUCTION, prompt).content.strip(),
+        prompts
+    )
+    combined = join_section_results(partial)
+    # Если частичные выводы всё ещё слишком длинные, они сводятся ещё одним проходом
+    if count_tokens(combined) > DIRECT_INPUT_TOKENS:
+        return summarize_sections(client, combined, language)
+    prompt = (
+        f"В рамках следственных действий установите достоверность показаний. Ниже приведены краткие выводы по "
+        f"последовательным фрагментам одних показаний. Объедините их в общий вывод на языке {language}:\n\n"
+        f"{combined}\n\n"
+        "Дайте краткий вывод основных моментов, с учетом роли следствия в установлении достоверности показаний."
+    )
+    return request_completion(client, "summary", SUMMARY_INSTRUCTION, prompt).content.strip()
 
 def summarize_text(client, text, language='ru'):
     prompt = (
@@ -167,77 +1781,142 @@ def summarize_text(client, text, language='ru'):
         "Дайте краткий вывод основных моментов, с учетом роли следствия в установлении достоверности показаний."
     )
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "developer", "content": "Вы действуете как опытный следователь, оценивающий достоверность показаний."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.5,
-        )
-        summary = response.choices[0].message.content.strip()
-        return summary
+        if count_tokens(text) > DIRECT_INPUT_TOKENS:
+            return summarize_sections(client, text, language)
+        return request_completion(client, "summary", SUMMARY_INSTRUCTION, prompt).content.strip()
     except Exception as e:
         st.error(f"Ошибка при суммаризации: {str(e)}")
         return ""
 
 def check_sequence(client, text):
-    prompt = (
-        "Проанализируйте следующий текст показаний с точки зрения следственных действий. Проверьте логическую последовательность изложения и "
-        "выделите несоответствия или пропущенные шаги, важные для установления достоверности показаний:\n\n" + text
-    )
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "developer", "content": "Вы следователь, оценивающий последовательность изложения показаний."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.5,
+    def check(section):
+        prompt = (
+            "Проанализируйте следующий текст показаний с точки зрения следственных действий. Проверьте логическую последовательность изложения и "
+            "выделите несоответствия или пропущенные шаги, важные для установления достоверности показаний:\n\n" + section
         )
-        analysis = response.choices[0].message.content.strip()
-        return analysis
+        return request_completion(
+            client, "sequence", "Вы следователь, оценивающий последовательность изложения показаний.", prompt
+        ).content.strip()
+
+    try:
+        if count_tokens(text) <= DIRECT_INPUT_TOKENS:
+            return check(text)
+        # Длинная транскрипция проверяется по фрагментам
+        return join_section_results(map_parallel(check, split_text_sections(text, SECTION_TOKENS)))
     except Exception as e:
         st.error(f"Ошибка при проверке последовательности: {str(e)}")
         return ""
 
 def extract_key_facts(client, text):
-    prompt = (
-        "Извлеките из следующего текста ключевые факты, имеющие значение в следственном деле, которые помогут установить достоверность показаний:\n\n"
-        + text
-    )
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "developer", "content": "Вы следователь, выделяющий существенные факты для установления истины."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.5,
+    def extract(section):
+        prompt = (
+            "Извлеките из следующего текста ключевые факты, имеющие значение в следственном деле, которые помогут установить достоверность показаний:\n\n"
+            + section
         )
-        key_facts = response.choices[0].message.content.strip()
-        return key_facts
+        return request_completion(
+            client, "key_facts", "Вы следователь, выделяющий существенные факты для установления истины.", prompt
+        ).content.strip()
+
+    try:
+        if count_tokens(text) <= DIRECT_INPUT_TOKENS:
+            return extract(text)
+        # Длинная транскрипция обрабатывается по фрагментам
+        return join_section_results(map_parallel(extract, split_text_sections(text, SECTION_TOKENS)))
     except Exception as e:
         st.error(f"Ошибка при извлечении ключевых фактов: {str(e)}")
         return ""
 
-def check_contradictions(client, text1, text2):
+# Совмещённый анализ: суммаризация, проверка последовательности и ключевые факты одним запросом,
+# чтобы транскрипция отправлялась модели один раз, а не трижды
+ANALYSIS_MODE = get_setting("analysis_mode", "combined")
+
+ANALYSIS_SCHEMA = {
+    "name": "testimony_analysis",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "summary": {"type": "string"},
+            "sequence_issues": {"type": "array", "items": {"type": "string"}},
+            "key_facts": {"type": "array", "items": {"type": "string"}},
+        },
+        "required": ["summary", "sequence_issues", "key_facts"],
+        "additionalProperties": False,
+    },
+}
+
+def format_analysis_list(items, empty):
+    items = [item.strip() for item in items if item.strip()]
+    if not items:
+        return empty
+    return "\n".join(f"- {item}" for item in items)
+
+def analyze_text_combined(client, text, language='ru'):
     prompt = (
-        "Сравните следующие два показания и определите противоречия или расхождения между ними, которые могут повлиять на достоверность показаний:\n\n"
-        "Показания лица №1:\n" + text1 + "\n\n"
-        "Показания лица №2:\n" + text2
+        "В рамках следственных действий проанализируйте следующий текст показаний и верните:\n"
+        f"summary — краткий вывод основных моментов на языке {language}, с учетом роли следствия в установлении достоверности показаний;\n"
+        "sequence_issues — несоответствия или пропущенные шаги в логической последовательности изложения, "
+        "важные для установления достоверности показаний;\n"
+        "key_facts — ключевые факты, имеющие значение в следственном деле, которые помогут установить достоверность показаний.\n\n"
+        + text
+    )
+    # Ошибки не выводятся на страницу: при сбое analyze_testimony переходит к отдельным запросам
+    message = request_completion(
+        client, "combined", SUMMARY_INSTRUCTION, prompt,
+        response_format={"type": "json_schema", "json_schema": ANALYSIS_SCHEMA},
     )
+    if getattr(message, "refusal", None):
+        raise ValueError(message.refusal)
+    result = json.loads(message.content)
+    return (
+        result["summary"].strip(),
+        format_analysis_list(result["sequence_issues"], "Несоответствий в последовательности изложения не выявлено."),
+        format_analysis_list(result["key_facts"], "Ключевые факты не выявлены."),
+    )
+
+def analyze_testimony(client, text, language='ru', mode=None):
+    # Возвращает (суммаризация, анализ последовательности, ключевые факты)
+    mode = mode or ANALYSIS_MODE
+    if mode not in ("combined", "separate"):
+        raise ValueError(f"Неизвестный режим анализа: {mode}")
+    # Длинная транскрипция не помещается в один запрос: анализы выполняются по фрагментам
+    if mode == "combined" and count_tokens(text) <= DIRECT_INPUT_TOKENS:
+        try:
+            return analyze_text_combined(client, text, language)
+        except Exception as e:
+            # При сбое структурированного ответа анализ выполняется отдельными запросами;
+            # результаты полные, поэтому это не ошибка, а пояснение
+            st.caption(f"Совмещённый анализ не удался ({str(e)}), выполнен анализ отдельными запросами.")
+    # Три анализа не зависят друг от друга и выполняются одновременно
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        summary = pool.submit(with_script_run_ctx(summarize_text), client, text, language)
+        sequence_check = pool.submit(with_script_run_ctx(check_sequence), client, text)
+        key_facts = pool.submit(with_script_run_ctx(extract_key_facts), client, text)
+        return summary.result(), sequence_check.result(), key_facts.result()
+
+def condense_testimony(client, text, budget, language, summary=""):
+    # Показания, не помещающиеся в свою половину запроса, заменяются сводкой;
+    # уже полученная при анализе показаний суммаризация используется повторно
+    if count_tokens(text) <= budget:
+        return text
+    if summary:
+        return summary
+    return summarize_sections(client, text, language)
+
+def check_contradictions(client, text1, text2, language='ru', summary1="", summary2=""):
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "developer", "content": "Вы следователь, сопоставляющий показания для выявления противоречий."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.5,
+        text1, text2 = map_parallel(
+            lambda item: condense_testimony(client, item[0], DIRECT_INPUT_TOKENS // 2, language, item[1]),
+            [(text1, summary1), (text2, summary2)]
+        )
+        prompt = (
+            "Сравните следующие два показания и определите противоречия или расхождения между ними, которые могут повлиять на достоверность показаний:\n\n"
+            "Показания лица №1:\n" + text1 + "\n\n"
+            "Показания лица №2:\n" + text2
         )
-        contradictions = response.choices[0].message.content.strip()
-        return contradictions
+        return request_completion(
+            client, "contradictions", "Вы следователь, сопоставляющий показания для выявления противоречий.", prompt
+        ).content.strip()
     except Exception as e:
         st.error(f"Ошибка при проверке противоречий: {str(e)}")
         return ""
@@ -248,27 +1927,156 @@ def formulate_questions(client, contradictions):
         + contradictions
     )
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "developer", "content": "Вы следователь, формирующий вопросы для уточнения показаний."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.7,
-        )
-        questions = response.choices[0].message.content.strip()
-        return questions
+        return request_completion(
+            client, "questions", "Вы следователь, формирующий вопросы для уточнения показаний.", prompt, temperature=0.7
+        ).content.strip()
     except Exception as e:
         st.error(f"Ошибка при формировании вопросов: {str(e)}")
         return ""
 
+# ----------------------- Отображение хода транскрибации -----------------------
+def show_transcript_progress(placeholder, person):
+    # Транскрипция заполняется по мере готовности частей, по порядку,
+    # чтобы следователь начал читать, не дожидаясь окончания всей записи
+    def update(transcript, completed, total):
+        with placeholder.container():
+            st.progress(completed / total, text=f"Транскрибировано частей: {completed} из {total}")
+            st.text_area(
+                f"Транскрипция лица №{person} (в процессе)",
+                value=transcript.text,
+                height=200,
+                key=f"live_transcript_{person}_{completed}",
+                disabled=True
+            )
+    return update
+
+# ----------------------- Обработка материала одного лица -----------------------
+def process_witness(client, uploaded_file, person, language, remove_pauses, container):
+    # Проверка, извлечение аудио, транскрибация и анализ показаний одного лица;
+    # ход обработки выводится в отведённый лицу блок страницы
+    result = {
+        "transcript": None,
+        "transcription": "",
+        "summary": "",
+        "sequence_check": "",
+        "key_facts": "",
+        "live_transcript": None,
+    }
+    with container:
+        st.markdown(f"### Обработка показаний лица №{person}")
+        try:
+            with st.spinner(f"Проверка файла лица №{person}..."):
+                media = preflight_media(uploaded_file)
+            # Кэш проверяется по хэшу загрузки до извлечения аудио: при попадании ffmpeg не запускается
+            key = None
+            transcript = None
+            if TRANSCRIPT_CACHE_ENABLED or TRANSCRIBE_CHECKPOINTS:
+                key = get_transcript_cache_key(
+                    media["sha256"], language, get_transcription_backend()["model"],
+                    resolve_encoding_profile(ENCODING_PROFILE), get_vad_signature() if remove_pauses else None
+                )
+            if TRANSCRIPT_CACHE_ENABLED:
+                transcript = lookup_cached_transcript(key)
+            if transcript is not None:
+                discard_media(media)
+                st.caption("Транскрипция этого материала найдена в кэше.")
+            else:
+                with st.spinner(f"Извлечение аудио для лица №{person}..."):
+                    audio_path, meta = extract_audio(uploaded_file, media)
+                    copied = ", дорожка скопирована без перекодирования" if meta.get("mode") == "copy" else ""
+                    st.write(f"Длительность аудио: {int(meta['duration'])} сек. (профиль кодирования: {meta['profile']}{copied})")
+                    if meta.get("ingest"):
+                        st.caption(format_ingest_stats(meta["ingest"]))
+                if remove_pauses:
+                    with st.spinner(f"Удаление пауз для лица №{person}..."):
+                        audio_path, meta = remove_silence(audio_path, meta)
+                        if meta.get("time_map"):
+                            st.write(f"Длительность речи: {int(meta['duration'])} сек.")
+                result["live_transcript"] = st.empty()
+                with st.spinner(f"Транскрибация показаний лица №{person}..."):
+                    transcript = transcribe_audio(
+                        client, audio_path, language, meta['duration'], profile=meta['profile'],
+                        on_progress=show_transcript_progress(result["live_transcript"], person),
+                        time_map=meta.get("time_map"), cache_key=key
+                    )
+            result["transcript"] = transcript
+            result["transcription"] = transcript.text
+            with st.spinner(f"Анализ показаний лица №{person}..."):
+                result["summary"], result["sequence_check"], result["key_facts"] = analyze_testimony(
+                    client, result["transcription"], language
+                )
+        except Exception as e:
+            st.error(f"Ошибка при обработке материала лица №{person}: " + str(e))
+    return result
+
+def show_witness_results(result, person, case_number):
+    if not result["transcription"]:
+        return
+    # Промежуточная транскрипция заменяется итоговыми результатами
+    if result["live_transcript"] is not None:
+        result["live_transcript"].empty()
+    st.markdown(f"#### Результаты для лица №{person}")
+    st.text_area(f"Транскрипция лица №{person}", value=result["transcription"], height=200)
+    st.text_area(f"Суммаризация лица №{person}", value=result["summary"], height=100)
+    st.text_area(f"Анализ последовательности лица №{person}", value=result["sequence_check"], height=100)
+    st.text_area(f"Ключевые факты лица №{person}", value=result["key_facts"], height=100)
+    st.download_button(
+        f"⬇️ Скачать транскрипцию лица №{person}",
+        data=result["transcription"],
+        file_name=f"Протокол_лицо{person}_{case_number}.txt",
+        mime="text/plain"
+    )
+    st.download_button(
+        f"⬇️ Скачать транскрипцию лица №{person} с таймкодами",
+        data=format_timed_transcript(result["transcript"]),
+        file_name=f"Протокол_лицо{person}_таймкоды_{case_number}.txt",
+        mime="text/plain"
+    )
+
+# ----------------------- Расход токенов -----------------------
+def format_count(value):
+    return f"{value:,}".replace(",", " ")
+
+def show_token_usage():
+    usage = st.session_state.get("token_usage")
+    if not usage:
+        return
+    st.markdown("### 📊 Расход токенов")
+    col1, col2, col3 = st.columns(3)
+    col1.metric("Запросов к модели", sum(totals["requests"] for totals in usage.values()))
+    col2.metric(
+        "Входные токены",
+        format_count(sum(totals["prompt"] for totals in usage.values())),
+        help=f"По локальному подсчёту: {format_count(sum(totals['counted'] for totals in usage.values()))}"
+    )
+    col3.metric("Выходные токены", format_count(sum(totals["completion"] for totals in usage.values())))
+    st.dataframe(
+        [
+            {
+                "Задача": TASK_LABELS[task],
+                "Запросов": totals["requests"],
+                "Входные (подсчёт)": totals["counted"],
+                "Входные (API)": totals["prompt"],
+                "Выходные": totals["completion"],
+            }
+            for task, totals in usage.items()
+        ],
+        hide_index=True
+    )
+    if load_tokenizer(TOKENIZER_ENCODING) is None:
+        st.caption(
+            f"Токенизатор tiktoken недоступен (нет пакета или словаря в каталоге {TIKTOKEN_CACHE_DIR}, "
+            "см. tokenizer/README.md): локальный подсчёт приблизительный."
+        )
+
 # ----------------------- Основная функция приложения -----------------------
 def main():
     load_css()
 
     # Проверяем наличие FFmpeg
-    if not check_ffmpeg():
-        st.error("FFmpeg не установлен. Пожалуйста, установите FFmpeg для работы с видео.")
+    capabilities = get_ffmpeg_capabilities()
+    if not capabilities["ffmpeg"] or not capabilities["ffprobe"]:
+        st.error("FFmpeg не установлен. Пожалуйста, установите FFmpeg (вместе с ffprobe) для работы с видео.")
         st.stop()
 
     # Заголовок
@@ -314,97 +2122,74 @@ def main():
                 "en": "🇬🇧 English"
             }[x]
         )
+        remove_pauses = st.checkbox(
+            "Удалять паузы перед транскрибацией",
+            value=VAD_ENABLED,
+            help="Участки без речи не отправляются на транскрибацию; таймкоды сохраняются по исходной записи."
+        )
 
     st.markdown("---")
-    st.info(
+    # Транскрипции хранятся на сервере ограниченное время (кэш и незавершённые контрольные точки),
+    # поэтому уведомление не обещает удаления всех данных сразу после обработки
+    retention = []
+    if TRANSCRIPT_CACHE_ENABLED:
+        retention.append(f"кэш транскрипций — до {TRANSCRIPT_CACHE_MAX_AGE / 3600:g} ч")
+    if TRANSCRIBE_CHECKPOINTS:
+        retention.append(f"незавершённые транскрибации — до {CHECKPOINT_MAX_AGE / 86400:g} сут")
+    notice = (
         "ℹ️ Все материалы обрабатываются с соблюдением требований информационной безопасности. "
-        "Файлы автоматически удаляются после обработки."
+        "Загруженные файлы и аудио автоматически удаляются после обработки."
     )
+    if retention:
+        notice += (
+            " Тексты транскрипций временно хранятся на сервере в закрытом каталоге "
+            f"({', '.join(retention)}) и затем удаляются."
+        )
+    st.info(notice)
 
     if st.button("🚀 Начать обработку"):
-        transcription1 = transcription2 = ""
-        summary1 = summary2 = ""
-        sequence_check1 = sequence_check2 = ""
-        key_facts1 = key_facts2 = ""
-
-        # Обработка материала для лица №1
-        if uploaded_file_1:
-            st.markdown("### Обработка показаний лица №1")
-            try:
-                with st.spinner("Извлечение аудио для лица №1..."):
-                    audio_path1, duration1 = extract_audio(uploaded_file_1)
-                    st.write(f"Длительность аудио: {int(duration1)} сек.")
-                with st.spinner("Транскрибация показаний лица №1..."):
-                    transcription1 = transcribe_audio(client, audio_path1, language)
-                with st.spinner("Суммаризация показаний лица №1..."):
-                    summary1 = summarize_text(client, transcription1, language)
-                with st.spinner("Проверка логической последовательности для лица №1..."):
-                    sequence_check1 = check_sequence(client, transcription1)
-                with st.spinner("Извлечение ключевых фактов для лица №1..."):
-                    key_facts1 = extract_key_facts(client, transcription1)
-            except Exception as e:
-                st.error("Ошибка при обработке материала лица №1: " + str(e))
-        else:
-            st.warning("Материал для лица №1 не загружен.")
+        reset_token_usage()
+        # Материалы двух лиц обрабатываются одновременно, каждый в своём блоке страницы;
+        # сопоставление начинается после завершения обоих
+        uploads = {1: uploaded_file_1, 2: uploaded_file_2}
+        containers = {}
+        for person, uploaded_file in uploads.items():
+            if uploaded_file:
+                containers[person] = st.container()
+            else:
+                st.warning(f"Материал для лица №{person} не загружен.")
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            futures = {
+                person: pool.submit(
+                    with_script_run_ctx(process_witness), client, uploads[person], person,
+                    language, remove_pauses, container
+                )
+                for person, container in containers.items()
+            }
+            results = {person: future.result() for person, future in futures.items()}
 
-        # Обработка материала для лица №2
-        if uploaded_file_2:
-            st.markdown("### Обработка показаний лица №2")
-            try:
-                with st.spinner("Извлечение аудио для лица №2..."):
-                    audio_path2, duration2 = extract_audio(uploaded_file_2)
-                    st.write(f"Длительность аудио: {int(duration2)} сек.")
-                with st.spinner("Транскрибация показаний лица №2..."):
-                    transcription2 = transcribe_audio(client, audio_path2, language)
-                with st.spinner("Суммаризация показаний лица №2..."):
-                    summary2 = summarize_text(client, transcription2, language)
-                with st.spinner("Проверка логической последовательности для лица №2..."):
-                    sequence_check2 = check_sequence(client, transcription2)
-                with st.spinner("Извлечение ключевых фактов для лица №2..."):
-                    key_facts2 = extract_key_facts(client, transcription2)
-            except Exception as e:
-                st.error("Ошибка при обработке материала лица №2: " + str(e))
-        else:
-            st.warning("Материал для лица №2 не загружен.")
-
-        # Отображение результатов для лица №1
-        if transcription1:
-            st.markdown("#### Результаты для лица №1")
-            st.text_area("Транскрипция лица №1", value=transcription1, height=200)
-            st.text_area("Суммаризация лица №1", value=summary1, height=100)
-            st.text_area("Анализ последовательности лица №1", value=sequence_check1, height=100)
-            st.text_area("Ключевые факты лица №1", value=key_facts1, height=100)
-            st.download_button(
-                "⬇️ Скачать транскрипцию лица №1",
-                data=transcription1,
-                file_name=f"Протокол_лицо1_{case_number}.txt",
-                mime="text/plain"
-            )
+        for person, result in results.items():
+            show_witness_results(result, person, case_number)
 
-        # Отображение результатов для лица №2
-        if transcription2:
-            st.markdown("#### Результаты для лица №2")
-            st.text_area("Транскрипция лица №2", value=transcription2, height=200)
-            st.text_area("Суммаризация лица №2", value=summary2, height=100)
-            st.text_area("Анализ последовательности лица №2", value=sequence_check2, height=100)
-            st.text_area("Ключевые факты лица №2", value=key_facts2, height=100)
-            st.download_button(
-                "⬇️ Скачать транскрипцию лица №2",
-                data=transcription2,
-                file_name=f"Протокол_лицо2_{case_number}.txt",
-                mime="text/plain"
-            )
+        transcription1 = results[1]["transcription"] if 1 in results else ""
+        transcription2 = results[2]["transcription"] if 2 in results else ""
+        summary1 = results[1]["summary"] if 1 in results else ""
+        summary2 = results[2]["summary"] if 2 in results else ""
 
         # Сопоставление показаний и формирование вопросов, если оба материала загружены
         if transcription1 and transcription2:
             st.markdown("## Сопоставление показаний и установление достоверности")
             with st.spinner("Проверка противоречий между показаниями..."):
-                contradictions = check_contradictions(client, transcription1, transcription2)
+                contradictions = check_contradictions(
+                    client, transcription1, transcription2, language, summary1, summary2
+                )
             with st.spinner("Формирование вопросов для уточнения показаний..."):
                 questions = formulate_questions(client, contradictions)
             st.text_area("Найденные противоречия", value=contradictions, height=150)
             st.text_area("Сформированные вопросы", value=questions, height=150)
 
+        show_token_usage()
+
     # Футер
     st.markdown("---")
     st.markdown("""